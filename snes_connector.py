@@ -47,30 +47,46 @@
 #          emissive: #000000 (default)
 #          ambient: #4c3a18 (default)
 #          shininess: 40%
+#
+# A note on speed, if you're here to make this faster: nearly all the
+# run time is spent inside OpenCASCADE, building and exporting
+# geometry. The Python that drives it barely registers, so numba,
+# Cython, SIMD and friends have nothing to chew on. What helps is
+# asking OCCT to do less work: build shared parts once and place
+# instances of them, draw features into a sketch when they run the
+# full length of an extrude (the grip notches and standoff rails),
+# hand fillets all their edges in one go, and run independent exports
+# in parallel.
 
 __author__ = "David Anderson"
 __contact__ = "dave@natulte.net"
 __license__ = "CERN-OHL-P-2.0"
 
-import contextlib
-import math
-import copy
-import enum
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
 import sys
 from types import SimpleNamespace
-from build123d import *
+from build123d import (
+    Align, Axis, BasePartObject, BaseSketchObject, BuildLine, BuildPart,
+    BuildSketch, CenterArc, Circle, Color, Compound, FilletPolyline,
+    GeomType, GridLocations, Locations, Mode, Part, Plane, Polyline, Pos,
+    Rectangle, Rot, Vector, add, export_step, extrude, fillet, make_face,
+    pack, sweep,
+)
 
 # If true, show(...) sends the geometry over to the cadquery vscode
 # viewer for interactive rendering.
 dev = len(sys.argv) == 2 and sys.argv[1] == "dev"
+if dev:
+    from ocp_vscode import set_defaults, show as ocp_show, Camera
+    set_defaults(reset_camera=Camera.KEEP)
 
 def show(obj, *, stop=False):
     if not dev:
         return
 
-    from ocp_vscode import set_defaults, show, Camera
-    set_defaults(reset_camera=Camera.KEEP)
-
     if isinstance(obj, list):
         if len(obj) == 1:
             objs = obj
@@ -83,7 +99,7 @@ def show(obj, *, stop=False):
             obj.locate(Pos(adjust))
     else:
         objs = [obj]
-    show(obj)
+    ocp_show(obj)
 
     # Print outer dimensions for each object, as a way to quickly
     # validate critical dimensions.
@@ -170,9 +186,24 @@ def params():
             return self
 
         def __exit__(self, exc_type, exc_value, traceback):
-            self.__setattr__ = 4
             return False
 
+        def freeze(self):
+            ret = frozen()
+            for k, v in vars(self).items():
+                vars(ret)[k] = v.freeze() if isinstance(v, self.__class__) else v
+            return ret
+
+    # Once it's all set up, the config is read-only, and asking for a
+    # setting that doesn't exist is an error rather than a brand new
+    # empty namespace.
+    class frozen(cfg):
+        def __getattr__(self, k):
+            raise AttributeError(f"no such setting: {k}")
+
+        def __setattr__(self, k, v):
+            raise AttributeError(f"settings are read-only, can't set {k}")
+
     cfg = cfg()
 
     # The pins are the whole point of having a connector.
@@ -193,11 +224,18 @@ def params():
         p.elbow_radius = p.diameter
         # A lot of the inside details of the connector are built by
         # reference to the positions of the pin centerlines as they go
-        # through the connector body. Precalculate those positions here as
-        # 1D vectors so the rest of the code needn't math as much.
+        # through the connector body. Precalculate those positions here,
+        # as plain X coordinates for doing math with and as 1D vectors
+        # for placing things, so the rest of the code needn't math as
+        # much.
         gaps = [4, 4, 4, 6.5, 4, 4]
         p0 = -sum(gaps)/2
-        p.pos = [Vector(p0+sum(gaps[:i])) for i in range(7)]
+        p.pos_x = tuple(itertools.accumulate(gaps, initial=p0))
+        p.pos = [Vector(x) for x in p.pos_x]
+        # The midpoint of the wider gap between the two groups of
+        # pins. The insert is split there, and it's the connector's
+        # origin once assembled.
+        p.gap_center = (p.pos_x[3] + p.pos_x[4])/2
 
 
     # The body is the basic outer shell of the connector, before you
@@ -229,11 +267,10 @@ def params():
     # designed, so that when it's sitting on a PCB the connector body
     # can flex a bit without transferring excessive force to the
     # board. These dimensions are currently all eyeballed from 65X
-    # photos.
+    # photos. They run the full depth of the body.
     with cfg.body.standoffs as s:
         s.width = p.diameter
         s.height = 0.5
-        s.depth = b.depth
         distance_from_edge = 7.5
         s.spacing = b.width - 2*distance_from_edge - s.width
 
@@ -277,10 +314,11 @@ def params():
         # eyeballing photos looks like about one pin width.
         diam = cfg.pin.diameter
         margin = diam
-        g.width = (cfg.pin.pos[6] - cfg.pin.pos[0]).length + cfg.pin.diameter + 2*margin
+        g.width = cfg.pin.pos_x[6] - cfg.pin.pos_x[0] + cfg.pin.diameter + 2*margin
         g.height = diam + 2*margin
+        # The notches that the pins sit in go through the whole
+        # height of the grip.
         g.notch.width = diam
-        g.notch.height = g.height
         g.notch.depth = diam
 
 
@@ -294,7 +332,7 @@ def params():
         b.fillet_everything = False
         b.fillet = 0.2
 
-    return cfg
+    return cfg.freeze()
 
 cfg = params()
 
@@ -302,6 +340,9 @@ cfg = params()
 # lot. In denser lines of math, this helps readability.
 half = lambda n: n/2
 
+# Pin positions as locations, for placing pins in the assembly.
+pin_locations = [Pos(v) for v in cfg.pin.pos]
+
 #################################################################
 ###                      Parts library                        ###
 ###                                                           ###
@@ -314,30 +355,37 @@ half = lambda n: n/2
 #
 # This shape comes up a bunch in this connector, so here's a helper
 # that makes a single 2D face in that shape, with requested outside
-# dimensions.
+# dimensions. Each size only gets drawn once per run, and is reused
+# after that.
+@functools.lru_cache(maxsize=None)
+def semistadium_sketch(width, height, fillet_radius):
+    with BuildSketch() as sk:
+        with BuildLine():
+            radius = half(height)
+            arc_x = half(width) - radius
+            line_points = [
+                ( arc_x,       -half(height)),
+                (-half(width), -half(height)),
+                (-half(width),  half(height)),
+                ( arc_x,        half(height)),
+            ]
+            if fillet_radius > 0:
+                FilletPolyline(line_points, radius=fillet_radius)
+            else:
+                Polyline(line_points)
+            # The round end is a half circle centered on the end of
+            # the straight section, so there's no need to make OCCT
+            # solve for a circle through three points.
+            CenterArc((arc_x, 0), radius, start_angle=-90, arc_size=180)
+        make_face()
+    return sk.sketch
+
+
 class SemiStadium(BaseSketchObject):
     def __init__(self, width, height, fillet_radius=0, mode=Mode.ADD):
-        with BuildSketch() as sk:
-            with BuildLine() as ln:
-                radius = half(height)
-                arc_x = half(width) - radius
-                line_points = [
-                    ( arc_x,       -half(height)),
-                    (-half(width), -half(height)),
-                    (-half(width),  half(height)),
-                    ( arc_x,        half(height)),
-                ]
-                if fillet_radius > 0:
-                    FilletPolyline(line_points, radius=fillet_radius)
-                else:
-                    Polyline(line_points)
-                ThreePointArc([
-                    ( arc_x,        half(height)),
-                    ( half(width),  0),
-                    ( arc_x,       -half(height))
-                ])
-            make_face()
-        super().__init__(obj=sk.sketch, mode=mode)
+        # No align is passed, so placing the sketch only ever makes
+        # moved copies of it and the cached original can go in as is.
+        super().__init__(obj=semistadium_sketch(width, height, fillet_radius), mode=mode)
 
 
 # The entire plastic part of the connector. Everything but the pins.
@@ -345,9 +393,16 @@ class Body(BasePartObject):
     def __init__(self):
         b = cfg.body
         with BuildPart() as body:
-            # Base connector shell
+            # Base connector shell. The PCB standoff rails run its
+            # whole depth, so they go in the same sketch and come out
+            # of the same extrude, instead of being fused on later.
             with BuildSketch():
                 SemiStadium(b.width, b.height, b.fillet)
+                with GridLocations(x_spacing=b.standoffs.spacing,
+                                   y_spacing=b.height + b.standoffs.height,
+                                   x_count=2,
+                                   y_count=2):
+                    Rectangle(b.standoffs.width, b.standoffs.height)
             extrude(amount=b.depth)
 
             # The flange on the front
@@ -360,29 +415,16 @@ class Body(BasePartObject):
                 SemiStadium(b.cavity.width, b.cavity.height, b.cavity.fillet)
             extrude(amount=b.cavity.depth, mode=Mode.SUBTRACT)
 
-            # PCB standoff rails
-            with GridLocations(x_spacing=b.standoffs.spacing,
-                               y_spacing=b.height + b.standoffs.height,
-                               x_count=2,
-                               y_count=2):
-                Box(b.standoffs.width, b.standoffs.height, b.standoffs.depth,
-                    align=(Align.CENTER, Align.CENTER, Align.MIN))
-
-            # Housing's cosmetic fillets
-            if cfg.bling.fillet_everything:
-                faces = body.faces().filter_by(Plane.XY).sort_by(Axis.Z)
-                wires = faces[-2:].wires() + faces[0].wires()
-                for wire in wires:
-                    fillet(wire.edges(), cfg.bling.fillet)
-
+            # The inserts and the pin grip get built on their own, and
+            # then fused onto the housing together in a single boolean.
+            #
             # Inserts
             with BuildSketch(Plane.XY.offset(b.depth+b.inserts.stickout).reverse()) as inserts:
                 # Outer insert shape
                 SemiStadium(b.inserts.width, b.inserts.height)
 
                 # Cut out between the two pin groups
-                punchout_center = (cfg.pin.pos[3] + cfg.pin.pos[4])/2
-                with Locations(punchout_center):
+                with Locations((cfg.pin.gap_center, 0)):
                     Rectangle(b.inserts.gap, b.inserts.height, mode=Mode.SUBTRACT)
 
                 # Fillet the not yet rounded edges, before we punch more holes
@@ -392,50 +434,91 @@ class Body(BasePartObject):
                 # Holes for the pins
                 with Locations(cfg.pin.pos):
                     Circle(b.inserts.hole_radius, mode=Mode.SUBTRACT)
-            extrude(until=Until.NEXT)
-
-            # Insert's cosmetic fillets
+            # The inserts run from their front face back to the floor
+            # of the cavity.
+            insert_part = extrude(amount=b.inserts.stickout + b.cavity.depth, mode=Mode.PRIVATE)
+
+            # Pin grip on the rear side. The pin notches go all the way
+            # through the grip top to bottom, so the whole grip is a
+            # prism: sketch its outline as seen from above, notches
+            # included, and extrude it up and down in one go.
+            with BuildSketch(Plane.XZ):
+                Rectangle(b.grip.width, b.grip.depth, align=(Align.CENTER, Align.MAX))
+                with Locations([(x, -b.grip.depth) for x in cfg.pin.pos_x]):
+                    Rectangle(b.grip.notch.width, b.grip.notch.depth,
+                              align=(Align.CENTER, Align.MIN), mode=Mode.SUBTRACT)
+            grip_part = extrude(amount=half(b.grip.height), both=True, mode=Mode.PRIVATE)
+
+            add([insert_part, grip_part])
+
+            # Cosmetic fillets. These round over the edges of faces
+            # rather than the corners of a profile, so they can't be
+            # done in the 2D sketches. Instead they're left until all
+            # the solids are in place, so that the booleans above don't
+            # have to chew through all the extra faces.
             if cfg.bling.fillet_everything:
+                # Each fillet call rebuilds the whole solid, so hand it
+                # every edge that wants the same radius in one go: the
+                # front and back of the flange, the outline of the
+                # shell's rear face (but not where the grip meets it),
+                # and the outline of the insert fronts.
+                #
+                # Face positions come out of OCCT with some float
+                # noise, so look for them in a small window around
+                # where they should be rather than at exact values.
+                tol = 0.01
+                faces = body.faces().filter_by(Plane.XY)
+                flange = faces.filter_by_position(Axis.Z, b.depth - b.flange.depth - tol, b.depth + tol)
+                rear = faces.filter_by_position(Axis.Z, -tol, tol)
+                insert_fronts = faces.group_by(Axis.Z)[-1]
+                edges = [e for face in flange for e in face.edges()]
+                edges += [e for face in rear + insert_fronts for e in face.outer_wire().edges()]
+                fillet(edges, cfg.bling.fillet)
+
+                # The pin holes in the inserts get a smaller radius.
+                # The fillet above rebuilt the faces, so look them up
+                # again.
                 faces = body.faces().filter_by(Plane.XY).group_by(Axis.Z)[-1]
-                for face in faces:
-                    fillet(face.outer_wire().edges(), cfg.bling.fillet)
-                    fillet(face.inner_wires().edges(), cfg.bling.fillet/2)
-
-            # Pin grip on the rear side
-            Box(b.grip.width, b.grip.height, b.grip.depth,
-                align=(Align.CENTER, Align.CENTER, Align.MAX))
-            with BuildSketch(Plane.XY.offset(-b.grip.depth)):
-                with Locations(cfg.pin.pos):
-                    Rectangle(b.grip.notch.width, b.grip.notch.height)
-            extrude(amount=b.grip.notch.depth, mode=Mode.SUBTRACT)
+                fillet([e for face in faces for e in face.inner_wires().edges()],
+                       cfg.bling.fillet/2)
 
-            # A few final cosmetics for the future assembly.
-            body.part.label = "Body"
-            super().__init__(part=body.part)
-            self.color = Color(0.666, 0.666, 0.666) # guesstimated from online listings
+        # A few final cosmetics for the future assembly. This has to
+        # happen outside the BuildPart block: BasePartObject adds
+        # itself to whatever builder is active, and in there that
+        # means fusing the whole body with a copy of itself.
+        body.part.label = "Body"
+        super().__init__(part=body.part)
+        self.color = Color(0.666, 0.666, 0.666) # guesstimated from online listings
 
 
 # One pin, including its bend.
 class Pin(BasePartObject):
+    # Where the pin's centerline goes: from its tip inside the insert,
+    # back to just behind the grip, then down through the PCB. These
+    # are all known up front, so the assembly can use them rather
+    # than measuring the built pin.
+    front_z = cfg.body.depth + cfg.body.inserts.stickout - cfg.pin.insert_recess
+    rear_z = -(cfg.body.grip.depth + cfg.pin.rear_stickout)
+    bottom_y = -(cfg.body.height/2 + cfg.pin.pcb_stickout)
+
     def __init__(self):
         with BuildPart() as pin:
+            # Note that the YZ plane's local X and Y are global Y and Z.
             with BuildLine(Plane.YZ):
-                start_y = cfg.body.depth + cfg.body.inserts.stickout - cfg.pin.insert_recess
-                below_y = -(cfg.body.grip.depth + cfg.pin.rear_stickout)
-                end_x = -(cfg.body.height/2 + cfg.pin.pcb_stickout)
                 FilletPolyline([
-                    (0, start_y),
-                    (0, below_y),
-                    (end_x, below_y)
+                    (0, self.front_z),
+                    (0, self.rear_z),
+                    (self.bottom_y, self.rear_z)
                 ], radius=cfg.pin.elbow_radius)
 
             with BuildSketch(Plane.XY):
                 Circle(cfg.pin.radius)
             sweep()
 
-            # Round off the ends of the pins
-            fillet(pin.faces().filter_by(Plane.XY).face().edges(), cfg.pin.radius)
-            fillet(pin.faces().filter_by(Plane.XZ).face().edges(), cfg.pin.radius)
+            # Round off the ends of the pins. The end caps are the only
+            # flat faces on the swept pin, so one pass over the faces
+            # finds both, and they get rounded in a single fillet.
+            fillet(pin.faces().filter_by(GeomType.PLANE).edges(), cfg.pin.radius)
 
         # Cosmetic touches
         pin.part.label = "Pin (template)"
@@ -443,9 +526,18 @@ class Pin(BasePartObject):
         self.color = Color(0.859, 0.737, 0.494) # Kicad's "gold pins" diffuse
 
 
+# Places an instance of a prebuilt part. copy.copy() or loc * part
+# would deep copy all of the part's topology, so instead this wraps
+# the part's own TopoDS shape in a new Part, with only its location
+# changed. Every instance shares the template's geometry.
+def instance(template, loc, label):
+    return Part(template.wrapped.Moved(loc.wrapped),
+                label=label, color=template.color)
+
+
 # At last, we can assemble!
 class Connector(BasePartObject):
-    def __init__(self, mirror_image=False):
+    def __init__(self, body, pin, mirror_image=False):
         # There is a mirror operation in build123d, but it seems
         # weirdly expensive, and it fuses compound objects into a
         # single solid, which we don't want.
@@ -453,19 +545,12 @@ class Connector(BasePartObject):
         # Instead, we can play with rotations: rotate each pin so it
         # comes out the top of the connector, then assemble the pins
         # and body, then rotate that entire thing again. The result is
-        # a mirrored connector.
+        # a mirrored connector. It's also cheap: neither variant
+        # rebuilds the body or the pins, they both just place the
+        # shared ones differently.
         angle = 180 if mirror_image else 0
         mirror = Rot(0, 0, angle)
 
-        objects = [Body()]
-
-        pin = Pin()
-        for i, loc in enumerate(Locations(cfg.pin.pos).local_locations):
-            loc = loc * mirror # Maybe flip the pin around before moving it to final location
-            p = copy.copy(pin)
-            p.label = f"Pin {i+1}"
-            objects.append(p.locate(loc))
-
         # Almost there! Now we just have to rotate and adjust the
         # connector's position, so that it lines up with how KiCAD
         # wants to see it. In KiCAD's world, the XY plane is the top
@@ -474,9 +559,7 @@ class Connector(BasePartObject):
         #
         # Adjust so that X is sitting between the two pin groups,
         # rather than on the center of the bounding box.
-        x_3_to_4 = cfg.pin.pos[4] - cfg.pin.pos[3]
-        x_adjust = cfg.pin.pos[3] + x_3_to_4/2
-        final_pos = Pos(x_adjust.reverse())
+        final_pos = Pos(-cfg.pin.gap_center, 0, 0)
         # If we're building the mirrored version of the connector,
         # flip the entire thing now so the pins all point in the same
         # direction and react identically to the following
@@ -484,7 +567,9 @@ class Connector(BasePartObject):
         final_pos = mirror * final_pos
         # Next, the connector has to come up, so that when we rotate
         # about the X axis, the pins end up sticking down along y=0.
-        pin_z_adjust = objects[1].bounding_box().min.Z + cfg.pin.radius
+        # That's where the centerline of the pins' downward run sits,
+        # just behind the grip.
+        pin_z_adjust = Pin.rear_z
         final_pos = Pos(0, 0, -pin_z_adjust) * final_pos
         # Then rotate, so that Z is now "height above PCB".
         final_pos = Rot(90, 0, 0) * final_pos
@@ -494,49 +579,78 @@ class Connector(BasePartObject):
 
         # Apply the transform, build the final element, and we're
         # done!
-        objects = [final_pos * obj for obj in objects]
+        #
+        # The body and pin are identical in both variants, and are the
+        # expensive bits to build. Callers build them once and hand
+        # them in, and we only place instances of them here.
+        objects = [instance(body, final_pos, "Body")]
+        # Maybe flip the pins around before moving them to final location
+        objects += [instance(pin, final_pos * loc * mirror, f"Pin {i+1}")
+                    for i, loc in enumerate(pin_locations)]
+
+        # While developing, make sure placing the parts didn't copy
+        # them: every instance must still share its template's TShape.
+        if dev:
+            templates = [body] + [pin] * len(pin_locations)
+            assert all(obj.wrapped.IsPartner(template.wrapped)
+                       for obj, template in zip(objects, templates))
+
         final = Compound(label="Connector", children=objects)
 
         super().__init__(part=final)
 
 
-class Projection(enum.Enum):
-    FRONT = (Axis.Y, Axis.Z)
-    BACK = (-Axis.Y, Axis.Z)
-    LEFT = (Axis.X, Axis.Z)
-    RIGHT = (-Axis.X, Axis.Z)
-    TOP = (Axis.Z, Axis.Y)
-    BOTTOM = (-Axis.Z, Axis.Y)
-
-
-def project(obj, projection):
-    camera = projection.value[0].direction*100
-    up = projection.value[1].direction
-    look_at = Vector()
-    return obj.project_to_viewport(camera, up, look_at)
-
-
-def write_dxf(obj, projection, filename):
-    visible, _ = project(obj, projection)
-
-    max_dimension = max(*Compound(children=visible).bounding_box().size)
-    exp = ExportDXF(line_weight=0.1, line_type=LineType.CONTINUOUS)
-    exp.add_shape(visible)
-    exp.write(filename)
-
 # All that's left is to render out to STEP and be merry. Ideally also
 # apply the fancier materials, but build123d doesn't seem to know
 # how. Refer to the comment right at the top for how to load these
 # files into FreeCAD and fix up the materials.
+#
+# Variant name to mirror_image.
 variants = {
-    'right': Connector(False),
-    'left': Connector(True),
+    'right': False,
+    'left': True,
 }
 
-show(variants['left'])
-
-for variant, obj in variants.items():
+def build_and_export(variant, body, pin):
+    obj = Connector(body, pin, variants[variant])
     print(f"exporting {variant}-handed STEP")
     export_step(obj, f"SNES Controller Connector.pretty/snes_connector_{variant}.stp")
 
-print("done!")
+# Export worker processes get the shared body and pin once, when they
+# start, rather than along with every variant they're handed.
+worker_templates = None
+
+def init_worker(body, pin):
+    global worker_templates
+    worker_templates = (body, pin)
+
+def export_in_worker(variant):
+    build_and_export(variant, *worker_templates)
+
+if __name__ == "__main__":
+    # The body and pin are shared by both variants, so build them
+    # just once, here in the main process.
+    body = Body()
+    pin = Pin()
+
+    if dev:
+        show(Connector(body, pin, variants['left']))
+
+    # The variants don't depend on each other, and STEP export is a
+    # long single-threaded grind inside OCCT, so do them side by side
+    # in worker processes. Those have to be forked, so that they get
+    # the body and pin built above without pickling them. Forking is
+    # only safe to rely on on Linux (CPython documents it as unsafe on
+    # macOS), so elsewhere just do one variant after the other.
+    if sys.platform.startswith("linux"):
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=len(variants),
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=init_worker,
+                initargs=(body, pin)) as pool:
+            list(pool.map(export_in_worker, variants))
+    else:
+        for variant in variants:
+            build_and_export(variant, body, pin)
+
+    print("done!")
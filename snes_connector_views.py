@@ -0,0 +1,39 @@
+# 2D drawing helpers for the connector models built by
+# snes_connector.py: flat projections of a part along the main axes,
+# and DXF export of those projections.
+#
+# These live apart from the main script because nothing in the STEP
+# export needs them, and projecting a part means running OCCT's
+# hidden line removal, which is not something you want to pay for by
+# accident. Import this module when you want drawings.
+
+__author__ = "David Anderson"
+__contact__ = "dave@natulte.net"
+__license__ = "CERN-OHL-P-2.0"
+
+import enum
+from build123d import Axis, ExportDXF, LineType, Vector
+
+
+class Projection(enum.Enum):
+    FRONT = (Axis.Y, Axis.Z)
+    BACK = (-Axis.Y, Axis.Z)
+    LEFT = (Axis.X, Axis.Z)
+    RIGHT = (-Axis.X, Axis.Z)
+    TOP = (Axis.Z, Axis.Y)
+    BOTTOM = (-Axis.Z, Axis.Y)
+
+
+def project(obj, projection):
+    camera = projection.value[0].direction*100
+    up = projection.value[1].direction
+    look_at = Vector()
+    return obj.project_to_viewport(camera, up, look_at)
+
+
+def write_dxf(obj, projection, filename):
+    visible, _ = project(obj, projection)
+
+    exp = ExportDXF(line_weight=0.1, line_type=LineType.CONTINUOUS)
+    exp.add_shape(visible)
+    exp.write(filename)